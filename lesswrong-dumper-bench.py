@@ -0,0 +1,255 @@
+"""
+Benchmarks for lesswrong-dumper.py against a local stand-in for the GraphQL endpoint.
+
+The mock server answers batched multiCommentQuery, multiPostQuery and singleUserQuery requests with
+synthetic records, or with records replayed from a saved response, after a configurable latency and
+with a configurable share of failed requests. It runs in its own process so it doesn't compete with
+the client for the GIL.
+
+    python lesswrong-dumper-bench.py --posts 2000 --comments-per-post 20 --latency 0.05 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import time
+
+import requests
+from aiohttp import web
+
+
+def load_dumper():
+    # the dumper's file name has a dash in it, so it can't be imported by name
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lesswrong-dumper.py')
+    spec = importlib.util.spec_from_file_location('lesswrong_dumper', path)
+    dumper = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dumper)
+    return dumper
+
+
+def make_comment(post_id, i, text_bytes, template=None):
+    comment = dict(template) if template else {
+        'userId': f'u{i % 500}',
+        'user': {'_id': f'u{i % 500}', 'username': f'user{i % 500}'},
+        'postedAt': '2022-01-01T00:00:00.000Z',
+        'baseScore': i % 17,
+        'voteCount': i % 5,
+        'deleted': False,
+        'contents': {'_id': f'{post_id}-{i}-contents', 'version': '1.0.0',
+                     'html': '<p>' + 'x' * text_bytes + '</p>', 'plaintextMainText': 'x' * text_bytes},
+    }
+    comment['_id'] = f'{post_id}c{i}'
+    comment['postId'] = post_id
+    comment['parentCommentId'] = f'{post_id}c{i - 1}' if i % 3 else None
+    return comment
+
+
+class MockGraphQL:
+    """
+    Answers the dumper's GraphQL operations. Every post has comments_per_post comments. Half of the
+    failures are whole requests answered with a 503, the other half single queries answered with an
+    error entry, so both retry paths get exercised.
+    """
+    def __init__(self, comments_per_post=20, text_bytes=500, latency=0.0, error_rate=0.0, replay=None):
+        self.comments_per_post = comments_per_post
+        self.text_bytes = text_bytes
+        self.latency = latency
+        self.error_rate = error_rate
+        self.templates = replay or []
+        self.stats = {'requests': 0, 'queries': 0, 'bytes': 0, 'failed_requests': 0, 'failed_queries': 0}
+
+    def answer(self, query):
+        terms = query['variables']['input'].get('terms', {})
+        name = query.get('operationName')
+        if name == 'multiCommentQuery':
+            post_id = terms['postId']
+            offset = terms.get('offset', 0)
+            end = min(self.comments_per_post, offset + terms.get('limit', 5000))
+            results = [make_comment(post_id, i, self.text_bytes,
+                                    self.templates[i % len(self.templates)] if self.templates else None)
+                       for i in range(offset, end)]
+            return {'data': {'comments': {'results': results, 'totalCount': self.comments_per_post}}}
+        if name == 'multiPostQuery':
+            results = [{'_id': f'p{i}', 'userId': 'u1', 'user': {'_id': 'u1'}, 'title': 'bench',
+                        'postedAt': '2022-01-01T00:00:00.000Z', 'commentCount': self.comments_per_post}
+                       for i in range(terms.get('limit', 100))]
+            return {'data': {'posts': {'results': results, 'totalCount': len(results)}}}
+        if name == 'singleUserQuery':
+            user_id = query['variables']['input']['selector']['documentId']
+            return {'data': {'user': {'result': {'_id': user_id, 'username': f'user-{user_id}', 'karma': 1}}}}
+        return {'errors': [{'message': f'unsupported operation {name}'}], 'data': None}
+
+    async def handle(self, request):
+        self.stats['requests'] += 1
+        payload = await request.json()
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate / 2:
+            self.stats['failed_requests'] += 1
+            return web.Response(status=503, text='mock server busy')
+        queries = [payload] if isinstance(payload, dict) else payload
+        results = []
+        for query in queries:
+            self.stats['queries'] += 1
+            if random.random() < self.error_rate / 2:
+                self.stats['failed_queries'] += 1
+                results.append({'errors': [{'message': 'mock query failure'}], 'data': None})
+            else:
+                results.append(self.answer(query))
+        body = json.dumps(results[0] if isinstance(payload, dict) else results)
+        self.stats['bytes'] += len(body)
+        return web.Response(text=body, content_type='application/json')
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    def run(self, port):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post('/graphql', self.handle)
+        app.router.add_get('/stats', self.handle_stats)
+        web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(server):
+    port = free_port()
+    process = multiprocessing.Process(target=server.run, args=(port,), daemon=True)
+    process.start()
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(base_url + '/stats', timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    return process, base_url
+
+
+def server_stats(base_url):
+    return requests.get(base_url + '/stats').json()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if os.uname().sysname == 'Darwin' else peak / 1024
+
+
+def timed_run(base_url, name, run):
+    before = server_stats(base_url)
+    started = time.perf_counter()
+    records = run()
+    seconds = time.perf_counter() - started
+    after = server_stats(base_url)
+    requests_sent = after['requests'] - before['requests']
+    received = after['bytes'] - before['bytes']
+    return {
+        'benchmark': name,
+        'seconds': round(seconds, 3),
+        'records': records,
+        'requests': requests_sent,
+        'requests_per_sec': round(requests_sent / seconds, 1),
+        'mb_per_sec': round(received / 1024 ** 2 / seconds, 2),
+        'failed_requests': after['failed_requests'] - before['failed_requests'],
+        'failed_queries': after['failed_queries'] - before['failed_queries'],
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def bench_send_requests(dumper, base_url, args):
+    post_ids = [f'p{i}' for i in range(args.posts)]
+    payloads = [[{'operationName': 'multiCommentQuery',
+                  'variables': {'input': {'terms': {'view': 'postCommentsOld', 'postId': post_id, 'limit': 5000}}},
+                  'query': 'query multiCommentQuery { bench }'}
+                 for post_id in post_ids[start:start + args.chunk_size]]
+                for start in range(0, len(post_ids), args.chunk_size)]
+    results = dumper.send_requests_sync(base_url + '/graphql', payloads,
+                                        max_concurrent_requests=args.concurrency, delay_seconds=args.delay)
+    return sum(len(batch) for batch in results)
+
+
+def bench_get_posts_comments(dumper, base_url, args):
+    dumper.URL = base_url + '/graphql'
+    post_ids = [f'p{i}' for i in range(args.posts)]
+    df = dumper.get_posts_comments(post_ids, delay_seconds=args.delay, chunk_size=args.chunk_size,
+                                   max_concurrent_requests=args.concurrency,
+                                   comment_counts=[args.comments_per_post] * len(post_ids))
+    return len(df)
+
+
+def bench_flatten(dumper, args):
+    records = [make_comment(f'p{i // args.comments_per_post}', i % args.comments_per_post, args.text_bytes)
+               for i in range(args.flatten_records)]
+    started = time.perf_counter()
+    df = dumper.flatten_records(records, 'comment')
+    seconds = time.perf_counter() - started
+    return {
+        'benchmark': 'flatten_records',
+        'seconds': round(seconds, 3),
+        'records': len(df),
+        'seconds_per_100k': round(seconds / len(records) * 100000, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=1000, help='posts to fetch comments for')
+    parser.add_argument('--comments-per-post', type=int, default=20)
+    parser.add_argument('--text-bytes', type=int, default=500, help='size of each comment body')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean seconds the server waits per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests and queries that fail')
+    parser.add_argument('--replay', help='json file with a saved multiCommentQuery response to replay records from')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=0, help='seconds between requests per worker')
+    parser.add_argument('--chunk-size', type=int, default=10, help='queries per batched request')
+    parser.add_argument('--flatten-records', type=int, default=100000)
+    parser.add_argument('--only', choices=['send_requests', 'get_posts_comments', 'flatten_records'],
+                        action='append', help='run only these benchmarks')
+    parser.add_argument('--output', help='append the results as json lines to this file')
+    args = parser.parse_args()
+
+    replay = None
+    if args.replay:
+        with open(args.replay) as f:
+            saved = json.load(f)
+        saved = saved[0] if isinstance(saved, list) else saved
+        replay = saved['data']['comments']['results']
+
+    dumper = load_dumper()
+    server = MockGraphQL(args.comments_per_post, args.text_bytes, args.latency, args.error_rate, replay)
+    process, base_url = start_server(server)
+    selected = args.only or ['send_requests', 'get_posts_comments', 'flatten_records']
+    results = []
+    try:
+        if 'send_requests' in selected:
+            results.append(timed_run(base_url, 'send_requests',
+                                     lambda: bench_send_requests(dumper, base_url, args)))
+        if 'get_posts_comments' in selected:
+            results.append(timed_run(base_url, 'get_posts_comments',
+                                     lambda: bench_get_posts_comments(dumper, base_url, args)))
+        if 'flatten_records' in selected:
+            results.append(bench_flatten(dumper, args))
+    finally:
+        process.terminate()
+
+    for result in results:
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(dict(result, config=vars(args), time=time.time())) + '\n')
+
+
+if __name__ == '__main__':
+    main()
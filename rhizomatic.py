@@ -6,14 +6,30 @@
 __version__ = '20231108'
 
 from argparse import ArgumentParser
-from requests import get, head
-from requests.exceptions import RequestException
+from requests import get, head, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, HTTPError
 from dateutil import parser
 import sys
 from lxml import html
 import re
 import logging
 import csv
+import json
+import os
+import threading
+import time
+import heapq
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse, urlencode, quote, unquote
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+import run_metrics
 
 # Configure the logger
 logging.basicConfig(
@@ -24,6 +40,10 @@ logging.basicConfig(
 # Create a logger object for this script
 logger = logging.getLogger('rhizomatic')
 
+# failed requests are retried this many times, waiting RETRY_BACKOFF_SECONDS, then twice that, ...
+MAX_RETRIES = 4
+RETRY_BACKOFF_SECONDS = 2
+
 
 def bombout(msg):
     logger.error(msg)
@@ -32,136 +52,793 @@ def bombout(msg):
 def out(msg=''):
     print(msg)
 
-def get_page_history(wiki_url, offset:str='', limit:int=500):
-    # Use re.search to find the last section of the url
-    pattern = r'.*/([^/]+)+'
-    page_match = re.search(pattern, wiki_url)
-    if page_match:
-        title = page_match.group(1)
-    else:
-        logger.error("No title found")
-        raise ValueError("No title found")
+class HostThrottle:
+    """
+    Per-host politeness for concurrent crawls: at most max_concurrent requests in flight to a
+    host, and requests to it started at least min_interval seconds apart.
+    """
+    def __init__(self, max_concurrent=2, min_interval=0.5):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.next_start = {}
+
+    @contextmanager
+    def limit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            slot = self.slots.setdefault(host, threading.Semaphore(self.max_concurrent))
+        with slot:
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, self.next_start.get(host, now))
+                self.next_start[host] = start + self.min_interval
+            time.sleep(start - now)
+            yield
+
+
+def make_session(pool_size=10):
+    # one keep-alive connection pool shared by every worker thread
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = f'rhizomatic/{__version__}'
+    return session
+
+def timed_get(url, session=None, throttle=None):
+    # GET a url, recording latency, status and size in run_metrics
+    try:
+        with throttle.limit(url) if throttle else nullcontext():
+            with run_metrics.timer('request_seconds'):
+                response = session.get(url) if session else get(url)
+    except RequestException:
+        run_metrics.inc('requests_total', status='error')
+        raise
+    run_metrics.inc('requests_total', status=response.status_code)
+    run_metrics.inc('response_bytes_total', len(response.content))
+    return response
+
+def get_with_retries(url, session=None, throttle=None):
+    """
+    GET a url, retrying connection errors, 429s and 5xx responses up to MAX_RETRIES times with
+    exponential backoff. Other error statuses are raised straight away as HTTPError.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = timed_get(url, session, throttle)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response
+            error = HTTPError(f'{response.status_code} response from {url}', response=response)
+        except HTTPError:
+            raise
+        except RequestException as e:
+            error = e
+        if attempt == MAX_RETRIES:
+            raise error
+        wait = RETRY_BACKOFF_SECONDS * 2 ** attempt
+        logger.warning(f'{error}, retrying in {wait:.0f}s ({attempt + 1}/{MAX_RETRIES})')
+        run_metrics.inc('retries_total')
+        time.sleep(wait)
+
+def iter_page_history(wiki_url, offset:str='', limit:int=500, session=None, throttle=None, max_entries=None,
+                      progress=None):
+    # yields the entries of each history page as it is fetched. progress, if given, is kept up to date
+    # with the offset to carry on from after the page just yielded, whether that was the last one,
+    # and the error that stopped the history short
+    title = page_title(wiki_url)
+    # history lives on the same wiki as the page
+    host = urlparse(wiki_url).netloc or 'en.wikipedia.org'
       
-    history_url = f'https://en.wikipedia.org/w/index.php?title={title}&action=history&offset={offset}&limit={limit}'
-    all_entries = []
-   
-    
+    history_url = f'https://{host}/w/index.php?title={title}&action=history&offset={offset}&limit={limit}'
+    fetched = 0
     try:
         # if there are {limit} number of page entries, then there are entries remaining
         # keep fethcing until we've gotten all the entries
         while True:
             logger.info(f"fetching history for page {title}, {limit} entries starting at {offset}")
             logger.info(f"Sending request to {history_url}")
-            response = get(history_url)
-            document = html.document_fromstring(response.content)
+            response = get_with_retries(history_url, session, throttle)
+            with run_metrics.timer('stage_seconds', stage='parse'):
+                document = html.document_fromstring(response.content)
 
-            editors = document.xpath('//ul[contains(@class,"mw-contributions-list")]//bdi/text()')
-            edit_times = document.xpath('//ul[@class="mw-contributions-list"]//a[contains(@class,"mw-changeslist-date")]/text()')
+                editors = document.xpath('//ul[contains(@class,"mw-contributions-list")]//bdi/text()')
+                edit_times = document.xpath('//ul[@class="mw-contributions-list"]//a[contains(@class,"mw-changeslist-date")]/text()')
             page_entries = [(e,t,title) for e,t in zip(editors, edit_times)]
-            all_entries = all_entries + page_entries
-            if len(page_entries) < limit:
-                break
-            else:
+            fetched += len(page_entries)
+            more = len(page_entries) >= limit and not (max_entries and fetched >= max_entries)
+            if more:
                 last_page_date = parser.parse(edit_times[-1])
                 offset = int(last_page_date.strftime('%Y%m%d%H%M%S'))
-                history_url = f'https://en.wikipedia.org/w/index.php?title={title}&action=history&offset={offset}&limit={limit}'
+                history_url = f'https://{host}/w/index.php?title={title}&action=history&offset={offset}&limit={limit}'
+            if progress is not None:
+                progress.update(offset=offset, done=not more)
+            yield page_entries
+            if not more:
+                break
     except RequestException as e:
-        logger.error(e.strerror)
-        logger.error('error fetching page, restart at last offset')
-    finally:
-        return all_entries
+        logger.error(f'error fetching history for page {title}, can be resumed from offset {offset}')
+        logger.error(e)
+        if progress is not None:
+            progress['error'] = str(e)
 
 
-def get_user_edit_history(username, offset:str='', limit:int=500):
-    base_url = 'https://en.wikipedia.org/w/index.php'
+def get_page_history(wiki_url, offset:str='', limit:int=500, **kwargs):
+    return [entry for page in iter_page_history(wiki_url, offset, limit, **kwargs) for entry in page]
+
+
+def iter_user_edit_history(username, offset:str='', limit:int=500, session=None, throttle=None, host='en.wikipedia.org',
+                           max_entries=None, progress=None):
+    # yields the entries of each contributions page as it is fetched, keeping progress up to date
+    # like iter_page_history
+    base_url = f'https://{host}/w/index.php'
     contributions_url = 'Special:Contributions'
     wiki_url = f'{base_url}?title={contributions_url}&target={username}&limit={limit}&offset={offset}'
-    title_from_url_pattern = r'.*/([^/]+)+'
-    
-    all_entries = []
+
+    fetched = 0
     try:
         # if there are {limit} number of page entries, then there are entries remaining
         # keep fethcing until we've gotten all the entries
         while True:
             logger.info(f"fetching history for {username}, {limit} entries starting at {offset}")
             logger.info(f"Sending request to {wiki_url}")
-            response = get(wiki_url)        
-            response.raise_for_status()
-            document = html.document_fromstring(response.content)
-            edit_times = document.xpath('//a[contains(@class,"mw-changeslist-date")]/text()')
-            edit_page_titles = [re.search(title_from_url_pattern, url).group(1)
-                              for url in 
-                              document.xpath('//a[contains(@class,"mw-contributions-title")]/@href')
-                              ]
+            response = get_with_retries(wiki_url, session, throttle)
+            with run_metrics.timer('stage_seconds', stage='parse'):
+                document = html.document_fromstring(response.content)
+                edit_times = document.xpath('//a[contains(@class,"mw-changeslist-date")]/text()')
+                edit_page_titles = [page_title(url)
+                                  for url in 
+                                  document.xpath('//a[contains(@class,"mw-contributions-title")]/@href')
+                                  ]
             # extract the edit entries as a list of tuples and add them to bulk list
             page_entries = [(username, time, title) 
                             for time,title in 
                             zip(edit_times, edit_page_titles)
                             ]
-            all_entries = all_entries + page_entries
-            if len(page_entries) < limit:
-                break
-            else:
+            fetched += len(page_entries)
+            more = len(page_entries) >= limit and not (max_entries and fetched >= max_entries)
+            if more:
                 last_page_date = parser.parse(edit_times[-1])
                 offset = int(last_page_date.strftime('%Y%m%d%H%M%S'))
                 wiki_url = f'{base_url}?title={contributions_url}&target={username}&limit={limit}&offset={offset}'
+            if progress is not None:
+                progress.update(offset=offset, done=not more)
+            yield page_entries
+            if not more:
+                break
             
     except RequestException as e:
-        logger.error('error fetching page, restart at last offset')
+        logger.error(f'error fetching history for {username}, can be resumed from offset {offset}')
+        logger.error(e)
+        if progress is not None:
+            progress['error'] = str(e)
+
+
+def get_user_edit_history(username, offset:str='', limit:int=500, **kwargs):
+    return [entry for page in iter_user_edit_history(username, offset, limit, **kwargs) for entry in page]
+
+
+def api_query(api_url, params, continue_key, session=None, throttle=None, max_entries=None, offset=None,
+              progress=None):
+    """
+    Page through a MediaWiki api.php query, following its continue tokens until the results run out.
+
+    :param params: query parameters, without format or continue
+    :param continue_key: the list's continue parameter, rvcontinue or uccontinue
+    :param offset: continue parameters to start from, as saved in progress by an earlier run
+    :param progress: dict kept up to date with the continue parameters for the next request (offset)
+                     and whether there is one (done)
+    :return: yields the decoded json of every response
+    """
+    params = dict(params, format='json', formatversion=2, **(offset or {}))
+    fetched = 0
+    while True:
+        url = f'{api_url}?{urlencode(params)}'
+        logger.info(f"Sending request to {url}")
+        response = get_with_retries(url, session, throttle)
+        with run_metrics.timer('stage_seconds', stage='parse'):
+            data = json.loads(response.content)
+        if 'error' in data:
+            raise ValueError(f"{data['error'].get('code')}: {data['error'].get('info')}")
+        fetched += params.get('rvlimit', params.get('uclimit', 0))
+        more = 'continue' in data and not (max_entries and fetched >= max_entries)
+        if progress is not None:
+            progress.update(offset=data['continue'] if more else None, done=not more)
+        yield data
+        if not more:
+            break
+        logger.info(f"continuing from {continue_key}={data['continue'].get(continue_key)}")
+        params.update(data['continue'])
+
+
+def iter_page_revisions(wiki_url, offset=None, limit:int=500, session=None, throttle=None, max_entries=None,
+                        progress=None):
+    """
+    The edit history of a page from api.php prop=revisions: exact timestamps and revision ids
+    instead of scraping the rendered history page.
+
+    :param offset: continue parameters to start from, see api_query
+    :return: yields a list of (editor, timestamp, page, revision id) tuples per response, newest first
+    """
+    title = unquote(page_title(wiki_url))
+    host = urlparse(wiki_url).netloc or 'en.wikipedia.org'
+    api_url = f'https://{host}/w/api.php'
+    params = {'action': 'query', 'prop': 'revisions', 'titles': title, 'rvprop': 'ids|timestamp|user',
+              'rvlimit': limit}
+    try:
+        logger.info(f"fetching revisions for page {title}, {limit} per request")
+        for data in api_query(api_url, params, 'rvcontinue', session, throttle, max_entries, offset, progress):
+            for page in data.get('query', {}).get('pages', []):
+                if page.get('missing') or page.get('invalid'):
+                    logger.error(f'no page {title} on {host}')
+                    continue
+                page_name = page['title'].replace(' ', '_')
+                # editors hidden by revision deletion have no user
+                yield [(revision['user'], revision['timestamp'], page_name, revision['revid'])
+                       for revision in page.get('revisions', []) if 'user' in revision]
+    except RequestException as e:
+        logger.error(f'error fetching revisions for page {title}, can be resumed from the last continue token')
         logger.error(e)
-    finally:
-        return all_entries
+        if progress is not None:
+            progress['error'] = str(e)
+
+
+def get_page_revisions(wiki_url, offset=None, limit:int=500, **kwargs):
+    return [entry for page in iter_page_revisions(wiki_url, offset, limit, **kwargs) for entry in page]
+
+
+def iter_user_contributions(username, offset=None, limit:int=500, session=None, throttle=None, host='en.wikipedia.org',
+                            max_entries=None, progress=None):
+    """
+    A user's edits from api.php list=usercontribs.
+
+    :param offset: continue parameters to start from, see api_query
+
+    :return: yields a list of (editor, timestamp, page, revision id) tuples per response, newest first
+    """
+    api_url = f'https://{host}/w/api.php'
+    params = {'action': 'query', 'list': 'usercontribs', 'ucuser': username, 'ucprop': 'ids|timestamp|title',
+              'uclimit': limit}
+    try:
+        logger.info(f"fetching contributions for {username}, {limit} per request")
+        for data in api_query(api_url, params, 'uccontinue', session, throttle, max_entries, offset, progress):
+            yield [(username, contribution['timestamp'], contribution['title'].replace(' ', '_'), contribution['revid'])
+                   for contribution in data.get('query', {}).get('usercontribs', [])]
+    except RequestException as e:
+        logger.error(f'error fetching contributions for {username}, can be resumed from the last continue token')
+        logger.error(e)
+        if progress is not None:
+            progress['error'] = str(e)
+
+
+def get_user_contributions(username, offset=None, limit:int=500, **kwargs):
+    return [entry for page in iter_user_contributions(username, offset, limit, **kwargs) for entry in page]
+
+
+# page history and user history generators, and the columns of the entries they yield
+BACKENDS = {
+    'html': (iter_page_history, iter_user_edit_history, ['editor', 'timestamp', 'page']),
+    'api': (iter_page_revisions, iter_user_contributions, ['editor', 'timestamp', 'page', 'revision']),
+}
+
+
+class RecordedResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f'{self.status_code} recorded for this url', response=self)
 
 
-def write_tuples_to_csv(editing_history, output_file):
-    # Define the CSV headers
-    headers = ["editor", "timestamp", "page"]
-    with open(output_file, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(headers)
-        writer.writerows(editing_history)
+class RecordingSession:
+    """
+    Wraps a session and appends every response to a json lines file, which ReplaySession can
+    answer from later without touching the network.
+    """
+    def __init__(self, session, path):
+        self.session = session
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        response = self.session.get(url, **kwargs)
+        record = {'url': url, 'status': response.status_code, 'body': response.content.decode('utf-8', 'replace')}
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        return response
+
+
+class ReplaySession:
+    """
+    A stand-in session answering from responses saved by RecordingSession, for repeatable runs and
+    tests. Urls that weren't recorded get a 404.
+    """
+    def __init__(self, path):
+        self.responses = {}
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                self.responses[record['url']] = RecordedResponse(record['status'], record['body'].encode())
+
+    def get(self, url, **kwargs):
+        if url not in self.responses:
+            logger.error(f'no recorded response for {url}')
+            return RecordedResponse(404, b'')
+        return self.responses[url]
+
+
+def read_targets(path):
+    """
+    Read crawl targets from a file, or stdin for '-'. One per line: 'page <url>', 'user <name>', or
+    just a url (a page) or a name (a user). Blank lines and lines starting with # are skipped.
+    """
+    targets = []
+    with (sys.stdin if path == '-' else open(path)) as lines:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, _, value = line.partition(' ')
+            if kind in ('page', 'user') and value:
+                targets.append((kind, value.strip()))
+            elif line.startswith('http'):
+                targets.append(('page', line))
+            else:
+                targets.append(('user', line))
+    # keep the order, drop repeats
+    return list(dict.fromkeys(targets))
+
+def iter_crawl(targets, workers=8, max_per_host=2, min_interval=0.5, session=None, throttle=None,
+               host='en.wikipedia.org', max_entries=None, backend='html', seen=None, status=None, dedup=True):
+    """
+    Fetch the edit history of many pages and users concurrently through one pooled session,
+    with a per-host politeness limit.
+
+    :param targets: (kind, value) pairs, kind being 'page' (value is a url) or 'user'
+    :param host: wiki that user contributions are read from
+    :param max_entries: stop paging through a page's or user's history after this many entries
+    :param backend: 'html' to scrape the history pages, 'api' to read api.php
+    :param seen: entries not to yield again, added to as entries arrive
+    :param dedup: False to yield every entry and keep no set of them, when nothing can repeat
+    :param status: a CrawlStatus to record every target's progress in once its entries have been
+                   handled. Targets it has as done are skipped, unfinished ones carry on from their offset
+    :return: yields (target, entries) for every page of results as it arrives, with edits seen
+             from both a page and a user only yielded once unless dedup is off
+    """
+    session = session or make_session(pool_size=workers)
+    throttle = throttle or HostThrottle(max_per_host, min_interval)
+    page_history, user_history, _ = BACKENDS[backend]
+    # workers hand each page of results to this thread with their progress after it,
+    # and a None when their target is done
+    results = queue.Queue()
+
+    def crawl(target):
+        kind, value = target
+        progress = progresses[target]
+        resume = {'offset': status.offset(target)} if status and status.offset(target) else {}
+        if kind == 'page':
+            pages = page_history(value, session=session, throttle=throttle, max_entries=max_entries,
+                                 progress=progress, **resume)
+        else:
+            pages = user_history(value, session=session, throttle=throttle, host=host, max_entries=max_entries,
+                                 progress=progress, **resume)
+        for page_entries in pages:
+            results.put((target, page_entries, dict(progress)))
+
+    targets = list(dict.fromkeys(targets))
+    if status:
+        finished = [target for target in targets if status.done(target)]
+        if finished:
+            logger.info(f'skipping {len(finished)} targets finished by an earlier run')
+        targets = [target for target in targets if not status.done(target)]
+    # an error from an earlier run is cleared when the target is fetched again
+    progresses = {target: {'error': None} for target in targets}
+    seen = set() if seen is None else seen
+    counts = dict.fromkeys(targets, 0)
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for target in targets:
+            futures[target] = pool.submit(crawl, target)
+            futures[target].add_done_callback(lambda _, target=target: results.put((target, None, None)))
+        while done < len(targets):
+            target, page_entries, progress = results.get()
+            if page_entries is not None:
+                new_entries = page_entries
+                if dedup:
+                    new_entries = [entry for entry in page_entries if entry not in seen]
+                    seen.update(new_entries)
+                counts[target] += len(page_entries)
+                yield target, new_entries
+                # only now that the caller has written the entries is it safe to move the offset past them
+                if status:
+                    status.update(target, len(page_entries), **progress)
+                continue
+            done += 1
+            kind, value = target
+            error = futures[target].exception()
+            if isinstance(error, ValueError):
+                logger.error(f'skipping {kind} {value}: {error}')
+                if status:
+                    status.update(target, error=str(error))
+                continue
+            elif error:
+                raise error
+            if status:
+                status.update(target, **progresses[target])
+            distinct = f', {len(seen)} distinct so far' if dedup else ''
+            logger.info(f'[{done}/{len(targets)}] {kind} {value}: {counts[target]} entries{distinct}')
+
+
+def crawl_targets(targets, **kwargs):
+    # the merged history of all the targets, see iter_crawl
+    return sorted(entry for _, entries in iter_crawl(targets, **kwargs) for entry in entries)
+
+
+def page_title(wiki_url):
+    # everything after /wiki/, titles like AC/DC or User:X/sandbox have slashes of their own
+    path = urlparse(wiki_url).path
+    if '/wiki/' in path:
+        return path.split('/wiki/', 1)[1]
+    match = re.search(r'.*/([^/]+)+', wiki_url)
+    if not match:
+        logger.error("No title found")
+        raise ValueError("No title found")
+    return match.group(1)
+
+
+def expand_rhizome(seed_pages, depth=3, max_pages_per_level=25, max_users_per_level=50, min_shared=1,
+                   workers=8, max_per_host=2, min_interval=0.5, max_entries=5000, backend='html', session=None,
+                   writer=None, status=None):
+    """
+    Crawl outwards from seed pages, alternating page histories and user contributions:
+    seed pages -> their editors -> the pages those editors touched -> their editors -> ...
+
+    Every level is fetched concurrently. The next level is ranked by shared editors: a user scores
+    one point per crawled page they edited, a page one point per crawled editor who edited it.
+    Only the best ranked unvisited candidates are fetched, up to the level's cap, so the crawl
+    follows the seeds' editors and stays bounded however prolific they are.
+
+    :param seed_pages: full urls of the pages to start from
+    :param depth: number of levels to fetch, the seed pages being the first
+    :param min_shared: leave out candidates with fewer shared editors than this
+    :param max_entries: stop paging through one page's or user's history after this many entries
+    :param backend: 'html' to scrape the history pages, 'api' to read api.php
+    :param writer: a HistoryWriter to write the edits to as they arrive
+    :param status: a CrawlStatus to record the progress of every page and user in
+    :return: (every edit found, or how many were written if given a writer,
+              [(page title, shared editors)] for every page seen, best first)
+    """
+    host = urlparse(seed_pages[0]).netloc or 'en.wikipedia.org'
+    session = session or make_session(pool_size=workers)
+    throttle = HostThrottle(max_per_host, min_interval)
+    page_editors = {}
+    user_pages = {}
+    crawled_pages = set()
+    crawled_users = set()
+    seen = set()
+    frontier = [('page', url) for url in seed_pages]
+    # titles as the entries have them: api titles are plain text, html ones stay quoted as in the links
+    frontier_titles = [unquote(page_title(url)) if backend == 'api' else page_title(url) for url in seed_pages]
+    for level in range(depth):
+        if not frontier:
+            break
+        kind = frontier[0][0]
+        logger.info(f'level {level}: fetching {len(frontier)} {kind}s')
+        for _, entries in iter_crawl(frontier, workers=workers, session=session, throttle=throttle,
+                                     host=host, max_entries=max_entries, backend=backend, seen=seen,
+                                     status=status):
+            if writer:
+                writer.write(entries)
+            for entry in entries:
+                editor, timestamp, title = entry[:3]
+                page_editors.setdefault(title, set()).add(editor)
+                user_pages.setdefault(editor, set()).add(title)
+
+        # the next level is the other kind
+        if kind == 'page':
+            crawled_pages.update(frontier_titles)
+            scores = {user: len(pages & crawled_pages) for user, pages in user_pages.items()
+                      if user not in crawled_users}
+            cap, next_kind = max_users_per_level, 'user'
+        else:
+            crawled_users.update(user for _, user in frontier)
+            scores = {title: len(editors & crawled_users) for title, editors in page_editors.items()
+                      if title not in crawled_pages}
+            cap, next_kind = max_pages_per_level, 'page'
+        best = heapq.nlargest(cap, (item for item in scores.items() if item[1] >= min_shared),
+                              key=lambda item: (item[1], item[0]))
+        if next_kind == 'page':
+            frontier_titles = [title for title, _ in best]
+            frontier = [('page', f'https://{host}/wiki/{quote(title) if backend == "api" else title}')
+                        for title in frontier_titles]
+        else:
+            frontier = [('user', user) for user, _ in best]
+
+    # with a single level there are no crawled editors to compare against, so count all of them
+    related = [(title, len(editors & crawled_users) if crawled_users else len(editors))
+               for title, editors in page_editors.items()]
+    related.sort(key=lambda item: (-item[1], item[0]))
+    return len(seen) if writer else sorted(seen), related
+
+
+class CrawlStatus:
+    """
+    Per-target progress of a crawl, rewritten as json next to the output after every page: the
+    offset to carry on from, whether the target is done, how many entries it gave, and the error
+    that cut it short if one did. 'complete' says whether the output holds every target in full.
+    Loading it with resume=True lets iter_crawl pick each target up where it stopped.
+    """
+    def __init__(self, path, resume=False, **info):
+        self.path = path
+        self.lock = threading.Lock()
+        self.status = {'targets': {}}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.status = json.load(f)
+        self.status.update(info)
+        self.save()
+
+    @staticmethod
+    def key(target):
+        kind, value = target
+        return f'{kind} {value}'
+
+    def get(self, target):
+        return self.status['targets'].get(self.key(target), {})
+
+    def done(self, target):
+        return self.get(target).get('done', False) and not self.get(target).get('error')
+
+    def offset(self, target):
+        return self.get(target).get('offset')
+
+    def update(self, target, entries=0, **fields):
+        with self.lock:
+            target_status = self.status['targets'].setdefault(
+                self.key(target), {'entries': 0, 'done': False, 'offset': None, 'error': None})
+            target_status['entries'] += entries
+            target_status.update(fields)
+            self.save()
+
+    def partial(self):
+        # targets whose output is missing entries
+        return [key for key, target_status in self.status['targets'].items()
+                if not target_status['done'] or target_status['error']]
+
+    def save(self):
+        self.status['complete'] = not self.partial()
+        self.status['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.status, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class HistoryWriter:
+    """
+    Writes history entries out as they arrive, flushing after every page of results, so memory
+    stays flat however long a history is and a killed crawl keeps what it had fetched.
+    The format follows the file extension: .csv, .jsonl or .parquet. With append, csv and jsonl
+    output carries on from what an earlier run wrote.
+    """
+    def __init__(self, path, headers=("editor", "timestamp", "page"), append=False):
+        self.path = path
+        self.headers = list(headers)
+        self.format = os.path.splitext(path)[1].lstrip('.').lower()
+        self.rows = 0
+        self.writer = None
+        append = append and os.path.exists(path) and os.path.getsize(path) > 0
+        if self.format == 'parquet':
+            if pa is None:
+                raise ImportError('parquet output needs pyarrow: pip install pyarrow')
+            if append:
+                raise ValueError('parquet output can\'t be appended to, resume into csv or jsonl output')
+            self.schema = pa.schema([(name, pa.int64() if name == 'revision' else pa.string())
+                                     for name in self.headers])
+            self.writer = pq.ParquetWriter(path, self.schema)
+        elif self.format == 'jsonl':
+            self.file = open(path, mode='a' if append else 'w')
+        else:
+            self.file = open(path, mode='a' if append else 'w', newline='')
+            self.writer = csv.writer(self.file)
+            if not append:
+                self.writer.writerow(self.headers)
+                self.file.flush()
+
+    def write(self, entries):
+        if not entries:
+            return
+        with run_metrics.timer('stage_seconds', stage='write'):
+            if self.format == 'parquet':
+                columns = list(zip(*entries))
+                self.writer.write_table(pa.table(columns, schema=self.schema))
+            elif self.format == 'jsonl':
+                self.file.writelines(json.dumps(dict(zip(self.headers, entry))) + '\n' for entry in entries)
+                self.file.flush()
+            else:
+                self.writer.writerows(entries)
+                self.file.flush()
+        self.rows += len(entries)
+        run_metrics.inc('rows_written_total', len(entries))
+
+    def close(self):
+        if self.format == 'parquet':
+            self.writer.close()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_history(path, headers=("editor", "timestamp", "page")):
+    # the entries of a csv or jsonl output, as the tuples they were written from
+    with open(path, newline='') as file:
+        if path.endswith('.jsonl'):
+            rows = ([record[name] for name in headers] for record in map(json.loads, file))
+        else:
+            rows = csv.reader(file)
+            next(rows, None)
+        for row in rows:
+            yield tuple(int(value) if name == 'revision' else value for name, value in zip(headers, row))
+
+
+def write_tuples_to_csv(editing_history, output_file, headers=("editor", "timestamp", "page")):
+    with HistoryWriter(output_file, headers) as writer:
+        writer.write(editing_history)
 
 
 def main():
+    global MAX_RETRIES, RETRY_BACKOFF_SECONDS
     parser = ArgumentParser()
     parser.add_argument('-u', '--user', help='user to query')
     parser.add_argument('-p', '--page', help='full url of page to enumerate the editors from')
-    parser.add_argument('-o', '--output', help='output file (default: <url|user>.csv)')
+    parser.add_argument('-i', '--input', help="file of pages and users to crawl together, one per line, or - for stdin")
+    parser.add_argument('-o', '--output', help='output file, .csv, .jsonl or .parquet (default: <url|user|input>_history.<format>)')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl', 'parquet'], default='csv', help='format of the default output file (default: csv)')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='concurrent fetches in batch mode (default: 8)')
+    parser.add_argument('--per-host', type=int, default=2, help='concurrent requests per host (default: 2)')
+    parser.add_argument('--min-interval', type=float, default=0.5, help='seconds between requests to one host (default: 0.5)')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help=f'retries of a failed request, with exponential backoff (default: {MAX_RETRIES})')
+    parser.add_argument('--retry-backoff', type=float, default=RETRY_BACKOFF_SECONDS, help=f'seconds before the first retry (default: {RETRY_BACKOFF_SECONDS})')
+    parser.add_argument('--resume', action='store_true', help="carry on every unfinished page and user from where the last run with the same output stopped, "
+                        "going by the output's _status.json")
+    parser.add_argument('-x', '--expand', type=int, metavar='DEPTH', help='expand outwards from the page (or the pages in the input file) '
+                        'through their editors and the pages those edited, fetching DEPTH levels')
+    parser.add_argument('--max-pages', type=int, default=25, help='pages fetched per expansion level (default: 25)')
+    parser.add_argument('--max-users', type=int, default=50, help='users fetched per expansion level (default: 50)')
+    parser.add_argument('--min-shared', type=int, default=1, help='skip pages and users sharing fewer editors than this when expanding (default: 1)')
+    parser.add_argument('--max-entries', type=int, default=5000, help='history entries fetched per page or user when expanding (default: 5000)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='html',
+                        help='html scrapes the history pages, api reads api.php with exact timestamps and revision ids (default: html)')
+    parser.add_argument('--record', help='append every response to this json lines file')
+    parser.add_argument('--replay', help='answer requests from a file written by --record instead of the network')
+    parser.add_argument('--metrics', help='write run metrics to this file, Prometheus text if it ends in .prom, json lines otherwise')
+    parser.add_argument('--metrics-interval', type=float, help='also rewrite the metrics file every N seconds while running')
  
     args = parser.parse_args()
+    MAX_RETRIES, RETRY_BACKOFF_SECONDS = args.retries, args.retry_backoff
+    if args.metrics:
+        run_metrics.configure(args.metrics, live_seconds=args.metrics_interval)
     
     if args.output:
         output_filename = args.output
+    headers = BACKENDS[args.backend][2]
+    session = ReplaySession(args.replay) if args.replay else make_session(pool_size=args.workers)
+    if args.record:
+        session = RecordingSession(session, args.record)
 
-    if not (args.page or args.user):
-        print('Must specify either an Editor or Page\n')
+    if not (args.page or args.user or args.input):
+        print('Must specify either an Editor, a Page or an input file\n')
         parser.print_help()
         sys.exit(1)
-    elif args.user and args.page:
-        print('Must specify a user OR a Page, not both!')
+    elif sum(bool(target) for target in (args.user, args.page, args.input)) > 1:
+        print('Must specify a user OR a Page OR an input file, not several!')
         parser.print_help()
         sys.exit(1)
+    elif args.expand:
+        if args.user:
+            bombout('Expansion starts from pages, use --page or --input')
+        seeds = [args.page] if args.page else [value for kind, value in read_targets(args.input) if kind == 'page']
+        if not seeds:
+            bombout('No pages to expand from')
+        if not args.output:
+            name = page_title(args.page).replace('/', '_') if args.page else 'stdin' if args.input == '-' else os.path.splitext(os.path.basename(args.input))[0]
+            output_filename = f'wiki_rhizome_{name}_history.{args.format}'
+    elif args.input:
+        if not args.output:
+            name = 'stdin' if args.input == '-' else os.path.splitext(os.path.basename(args.input))[0]
+            output_filename = f'wiki_batch_{name}_history.{args.format}'
+        targets = read_targets(args.input)
+        logger.info(f'crawling {len(targets)} targets with {args.workers} workers')
     elif args.page:
         if not args.output:
             try:
                 title = re.search(r'.*/([^/]+)+', args.page).group(1)
-                output_filename = f'wiki_page_{title}_history.csv'
+                output_filename = f'wiki_page_{title}_history.{args.format}'
             except:
                 logger.error("Could not extract title from url")
                 sys.exit(1)
-        edit_history_tuples = get_page_history(args.page)
+        targets = [('page', args.page)]
     elif args.user:
         if not args.output:
-            output_filename = f'wiki_page_{args.user}_history.csv'
-        edit_history_tuples = get_user_edit_history(args.user)
+            output_filename = f'wiki_page_{args.user}_history.{args.format}'
+        targets = [('user', args.user)]
     else:
         bombout('How did you even get here?')
+
+    # progress of every target goes next to the output, for --resume and to tell a partial output from a full one
+    status_filename = os.path.splitext(output_filename)[0] + '_status.json'
+    resume = args.resume and os.path.exists(status_filename)
+    if args.resume:
+        if args.expand:
+            bombout('--resume carries on page, user and input file crawls, not expansions')
+        if not resume:
+            logger.warning(f'nothing to resume in {status_filename}, starting from the beginning')
+        else:
+            with open(status_filename) as f:
+                previous_backend = json.load(f).get('backend')
+            if previous_backend != args.backend:
+                bombout(f'{status_filename} is from a --backend {previous_backend} crawl')
+    status = CrawlStatus(status_filename, resume=resume, version=__version__, backend=args.backend,
+                         output=output_filename)
+
+    # entries are written as each page of results arrives
+    logger.info(f'{"appending" if resume else "writing"} to {output_filename}')
+    try:
+        writer = HistoryWriter(output_filename, headers, append=resume)
+    except ValueError as e:
+        bombout(e)
+    with writer:
+        if args.expand:
+            _, related = expand_rhizome(seeds, depth=args.expand, max_pages_per_level=args.max_pages,
+                                        max_users_per_level=args.max_users, min_shared=args.min_shared,
+                                        workers=args.workers, max_per_host=args.per_host,
+                                        min_interval=args.min_interval, max_entries=args.max_entries,
+                                        backend=args.backend, session=session, writer=writer, status=status)
+        else:
+            # so edits already written from one target, or by the run being resumed, aren't written
+            # again. A single fresh target can't repeat itself, so its entries aren't kept in memory
+            seen = set(read_history(output_filename, headers)) if resume else None
+            for _, entries in iter_crawl(targets, workers=args.workers, max_per_host=args.per_host,
+                                         min_interval=args.min_interval, backend=args.backend,
+                                         session=session, status=status, seen=seen,
+                                         dedup=resume or len(targets) > 1):
+                writer.write(entries)
+    logger.info(f'fetched {writer.rows} entries')
+    if args.expand:
+        related_filename = os.path.splitext(output_filename)[0] + '_related.csv'
+        logger.info(f'writing {len(related)} related pages to {related_filename}')
+        with open(related_filename, mode='w', newline='') as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(['page', 'shared_editors'])
+            csv_writer.writerows(related)
+    logger.info(f'run metrics:\n{run_metrics.summary()}')
+    partial = status.partial()
+    if partial:
+        logger.error(f'{len(partial)} of {len(status.status["targets"])} pages and users are incomplete, '
+                     f'see {status_filename}')
+        if args.expand:
+            # expansions can't be resumed, so the incomplete targets are written in --input's format
+            # to be crawled on their own
+            incomplete_filename = os.path.splitext(output_filename)[0] + '_incomplete.txt'
+            with open(incomplete_filename, 'w') as file:
+                file.writelines(f'{target}\n' for target in partial)
+            logger.error(f'Run again without --expand with --input {incomplete_filename} to fetch them')
+        else:
+            logger.error('Run again with --resume to carry on')
+        sys.exit(1)
     
-    logger.info(f'fetched {len(edit_history_tuples)} entries')
-    logger.info(f'writing to {output_filename}')
-    write_tuples_to_csv(edit_history_tuples, output_filename)
-    
-# awk command to concatenate all the wiki csvs
+# awk command to concatenate all the wiki csvs, no longer needed with --input
 # awk '(NR == 1) || (FNR > 1)' *.csv > wikipedia-page-edits.csv
 
 if __name__ == "__main__":
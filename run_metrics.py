@@ -0,0 +1,204 @@
+"""
+Run metrics shared by lesswrong-dumper.py and rhizomatic.py: counters, gauges, latency histograms
+and per-stage timers, written out as json lines or Prometheus text.
+
+Everything is recorded on the module level METRICS object. Recording is cheap and always on;
+nothing is written anywhere until configure() is called with an output path.
+
+    import run_metrics
+    run_metrics.configure('export_metrics.prom', live_seconds=10)
+    with run_metrics.timer('stage_seconds', stage='flatten'):
+        ...
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds, shared by every histogram. wide enough for both a json.loads and a slow request
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms, each keyed by name and an optional set of labels.
+
+    Gauges also remember the highest value they were set to, so a queue that filled up briefly
+    between snapshots still shows up in the final numbers.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_peaks = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        # label values are text in both outputs, and mixed types like status=200 and status='error'
+        # would not sort
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+            self.gauge_peaks[key] = max(value, self.gauge_peaks.get(key, value))
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observe how long the with block took, in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """ A json-serializable copy of every metric"""
+        def entries(values, field):
+            return [{'name': name, 'labels': dict(labels), field: value}
+                    for (name, labels), value in sorted(values.items())]
+        with self.lock:
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.append({'name': name, 'labels': dict(labels), 'count': histogram['count'],
+                                   'sum': round(histogram['sum'], 6),
+                                   'buckets': dict(zip(map(str, HISTOGRAM_BUCKETS), histogram['buckets']))})
+            return {
+                'time': time.time(),
+                'uptime_seconds': round(time.time() - self.started, 3),
+                'counters': entries(self.counters, 'value'),
+                'gauges': entries(self.gauges, 'value'),
+                'gauge_peaks': entries(self.gauge_peaks, 'value'),
+                'histograms': histograms,
+            }
+
+    def to_prometheus(self, prefix=''):
+        """ The metrics in the Prometheus text exposition format"""
+        def series(name, labels, extra=None):
+            labels = dict(labels, **(extra or {}))
+            label_text = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+            return f'{prefix}{name}{{{label_text}}}' if label_text else f'{prefix}{name}'
+
+        lines = []
+        typed = set()
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        lines.append(f'# TYPE {prefix}{name} {kind}')
+                        typed.add(name)
+                    lines.append(f'{series(name, labels)} {value}')
+            for (name, labels), value in sorted(self.gauge_peaks.items()):
+                if name + '_peak' not in typed:
+                    lines.append(f'# TYPE {prefix}{name}_peak gauge')
+                    typed.add(name + '_peak')
+                lines.append(f'{series(name + "_peak", labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'{series(name + "_bucket", labels, {"le": bound})} {cumulative}')
+                lines.append(f'{series(name + "_bucket", labels, {"le": "+Inf"})} {histogram["count"]}')
+                lines.append(f'{series(name + "_sum", labels)} {histogram["sum"]}')
+                lines.append(f'{series(name + "_count", labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write the metrics to path. A .prom file is rewritten with the current Prometheus text, which
+        is what node_exporter's textfile collector reads. Anything else gets a json line appended.
+        """
+        if path.endswith('.prom'):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+
+METRICS = Metrics()
+# set by configure()
+OUTPUT_PATH = None
+_live_thread = None
+_live_stop = threading.Event()
+
+
+def inc(name, value=1, **labels):
+    METRICS.inc(name, value, **labels)
+
+def set_gauge(name, value, **labels):
+    METRICS.set_gauge(name, value, **labels)
+
+def observe(name, value, **labels):
+    METRICS.observe(name, value, **labels)
+
+def timer(name, **labels):
+    return METRICS.timer(name, **labels)
+
+
+def configure(path, live_seconds=None):
+    """
+    Write the metrics to path when the run ends, and every live_seconds while it runs if given.
+
+    :param path: Output file. '.prom' for Prometheus text, anything else for json lines.
+    """
+    global OUTPUT_PATH, _live_thread
+    first_time = OUTPUT_PATH is None
+    OUTPUT_PATH = path
+    if first_time:
+        atexit.register(flush)
+    if live_seconds and _live_thread is None:
+        def write_periodically():
+            while not _live_stop.wait(live_seconds):
+                flush()
+        _live_thread = threading.Thread(target=write_periodically, name='run-metrics', daemon=True)
+        _live_thread.start()
+
+
+def flush():
+    """ Write the metrics to the configured output, if there is one"""
+    if OUTPUT_PATH is not None:
+        METRICS.write(OUTPUT_PATH)
+
+
+def summary():
+    """ One line per stage timer and counter, for printing at the end of a run"""
+    def title(entry):
+        return ' '.join([entry['name']] + [f'{k}={v}' for k, v in entry['labels'].items()])
+
+    snapshot = METRICS.snapshot()
+    lines = []
+    for histogram in snapshot['histograms']:
+        mean = histogram['sum'] / histogram['count'] if histogram['count'] else 0
+        lines.append(f"{title(histogram)}: {histogram['count']} x {mean * 1000:.1f}ms = {histogram['sum']:.2f}s")
+    for counter in snapshot['counters']:
+        lines.append(f"{title(counter)}: {counter['value']}")
+    return '\n'.join(lines)
@@ -0,0 +1,68 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+spec = importlib.util.spec_from_file_location('lesswrong_dumper',
+                                              os.path.join(os.path.dirname(__file__), 'lesswrong-dumper.py'))
+dumper = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dumper)
+
+
+class LocalStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'store.sqlite')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_two_stores_add_the_same_column(self):
+        # like export-range, which opens one store per interval on the same file
+        first, second = dumper.LocalStore(self.path), dumper.LocalStore(self.path)
+        try:
+            first.upsert('comment', pd.DataFrame({'_id': ['a'], 'contentKey': ['k1']}))
+            second.upsert('comment', pd.DataFrame({'_id': ['b'], 'contentKey': ['k2']}))
+            rows = first.query('SELECT _id, contentKey FROM comments ORDER BY _id')
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(rows.values.tolist(), [['a', 'k1'], ['b', 'k2']])
+
+    def test_two_sinks_add_the_same_column(self):
+        prefix = os.path.join(self.dir.name, 'store')
+        sinks = [dumper.SqliteSink(prefix, entity='comment'), dumper.SqliteSink(prefix, entity='comment')]
+        for index, sink in enumerate(sinks):
+            sink.write(pd.DataFrame({'_id': [str(index)], 'contentKey': [f'k{index}']}))
+        for sink in sinks:
+            sink.close()
+        store = dumper.LocalStore(dumper.SqliteSink.store_path(prefix))
+        try:
+            self.assertEqual(len(store.query('SELECT * FROM comments WHERE contentKey IS NOT NULL')), 2)
+        finally:
+            store.close()
+
+    def test_content_sinks_for_several_intervals(self):
+        # content mode adds contentKey, which is not in the schema, from every interval's sink
+        prefix = os.path.join(self.dir.name, 'store')
+        content_store = dumper.ContentStore(os.path.join(self.dir.name, 'content.sqlite'))
+        sinks = [dumper.open_sink(f'{prefix}_{month}', 'sqlite', entity='comment', content_store=content_store)
+                 for month in (1, 2)]
+        for index, sink in enumerate(sinks):
+            sink.write(pd.DataFrame({'_id': [str(index)], 'contents._id': [f'c{index}'],
+                                     'contents.version': ['1.0.0'], 'contents.html': [f'<p>body {index}</p>']}))
+        for sink in sinks:
+            sink.close()
+        store = dumper.LocalStore(dumper.SqliteSink.store_path(prefix))
+        try:
+            keys = store.query('SELECT contentKey FROM comments ORDER BY _id')['contentKey'].tolist()
+        finally:
+            store.close()
+        self.assertEqual([content_store.get(key)['text'] for key in keys], ['body 0', 'body 1'])
+        content_store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()